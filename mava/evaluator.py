@@ -138,7 +138,7 @@ def get_eval_fn(
             env_state, ts = jax.vmap(env.reset)(reset_keys)
 
             step_state = env_state, ts, key, init_act_state
-            _, timesteps = jax.lax.scan(_env_step, step_state, jnp.arange(env.time_limit + 1))
+            _, timesteps = jax.lax.scan(_env_step, step_state, xs=None, length=env.time_limit + 1)
 
             metrics = timesteps.extras["episode_metrics"]
             if config.env.log_win_rate:
@@ -199,8 +199,8 @@ def make_rec_eval_act_fn(actor_apply_fn: RecActorApply, config: DictConfig) -> E
     ) -> Tuple[Action, Dict]:
         hidden_state = actor_state[_hidden_state]
 
-        n_agents = timestep.observation.agents_view.shape[1]
-        last_done = timestep.last()[:, jnp.newaxis].repeat(n_agents, axis=-1)
+        n_envs, n_agents = timestep.observation.agents_view.shape[:2]
+        last_done = jnp.broadcast_to(timestep.last()[:, jnp.newaxis], (n_envs, n_agents))
         ac_in = (timestep.observation, last_done)
         ac_in = tree.map(lambda x: x[jnp.newaxis], ac_in)  # add batch dim to obs
 
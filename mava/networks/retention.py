@@ -12,11 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Tuple
+from typing import Any, Optional, Tuple
 
 import flax.linen as nn
 import jax
 import jax.numpy as jnp
+import numpy as np
 from chex import Array
 from omegaconf import DictConfig
 
@@ -30,6 +31,16 @@ from mava.networks.utils.sable import PositionalEncoding
 # T: number of timesteps
 
 
+def get_decay_kappas(n_head: int, decay_scaling_factor: float) -> np.ndarray:
+    """Decay kappa for each head.
+
+    Computed with numpy so that the kappas are embedded as constants rather than computed in
+    the traced graph.
+    """
+    decay_kappas = 1 - np.exp(np.linspace(np.log(1 / 32), np.log(1 / 512), n_head))
+    return (decay_kappas * decay_scaling_factor).astype(np.float32)
+
+
 class SimpleRetention(nn.Module):
     """Simple retention mechanism for Sable.
 
@@ -44,6 +55,7 @@ class SimpleRetention(nn.Module):
     masked: bool
     decay_kappa: float  # this is gamma in the original retention implementation
     memory_config: DictConfig
+    dtype: Any = jnp.float32  # Computation dtype, params are kept in float32
 
     def setup(self) -> None:
         # Initialise the weights
@@ -70,43 +82,80 @@ class SimpleRetention(nn.Module):
         B, C, _ = value.shape
 
         # Apply projection to q_proj, k_proj, v_proj
-        q_proj = query @ self.w_q
-        k_proj = key @ self.w_k
-        v_proj = value @ self.w_v
+        q_proj = query @ self.w_q.astype(self.dtype)
+        k_proj = key @ self.w_k.astype(self.dtype)
+        v_proj = value @ self.w_v.astype(self.dtype)
         k_proj = k_proj.transpose(0, -1, -2)
 
         # Compute next hidden state
         if self.memory_config.type == "ff_sable":
             # No decay matrix or xi for FF Sable since we don't have temporal dependencies.
-            decay_matrix = jnp.ones((B, C, C))
+            decay_matrix = jnp.ones((B, C, C), dtype=self.dtype)
             decay_matrix = self._causal_mask(decay_matrix)
-            xi = jnp.ones((B, C, 1))
+            xi = jnp.ones((B, C, 1), dtype=self.dtype)
             next_hstate = (k_proj @ v_proj) + hstate
+            inner_chunk = ((q_proj @ k_proj) * decay_matrix) @ v_proj
         else:
-            decay_matrix = self.get_decay_matrix(dones)
-            xi = self.get_xi(dones)
-            chunk_decay = self.decay_kappa ** (C // self.n_agents)
+            xi = self.get_xi(dones).astype(self.dtype)
+            T = C // self.n_agents
+            chunk_decay = self.decay_kappa**T
             delta = ~jnp.any(dones[:, :: self.n_agents], axis=1)[:, jnp.newaxis, jnp.newaxis]
+            # Decay of every token in the chunk relative to the last token of the chunk
+            last_decay = self.get_decay_matrix(dones, ts_start=T - 1)[:, -1].astype(self.dtype)
             next_hstate = (
-                k_proj @ (v_proj * decay_matrix[:, -1].reshape((B, C, 1)))
+                k_proj @ (v_proj * last_decay.reshape((B, C, 1)))
             ) + hstate * chunk_decay * delta
+            inner_chunk = self._tiled_inner_chunk(q_proj, k_proj, v_proj, dones)
 
-        # Compute the inner chunk and cross chunk
+        # Compute the cross chunk
         cross_chunk = (q_proj @ hstate) * xi
-        inner_chunk = ((q_proj @ k_proj) * decay_matrix) @ v_proj
 
         # Compute the final retention
         ret = inner_chunk + cross_chunk
         return ret, next_hstate
 
+    def _tiled_inner_chunk(
+        self, q_proj: Array, k_proj: Array, v_proj: Array, dones: Array
+    ) -> Array:
+        """Computes the inner chunk retention one tile of query timesteps at a time.
+
+        Retention has no softmax, so each tile of queries is independent of the others and there
+        is no running normalisation to carry between tiles. The decay matrix of each tile is
+        computed on the fly, so at most a (tile size x chunk size) decay matrix is materialised.
+        Since a query never retains keys from later timesteps, each tile only attends to the keys
+        up to its last timestep.
+        """
+        T = dones.shape[1] // self.n_agents
+        tile_size = self.memory_config.timestep_tile_size or T
+
+        inner_chunk = []
+        for ts_start in range(0, T, tile_size):
+            ts_stop = min(ts_start + tile_size, T)
+            start, stop = ts_start * self.n_agents, ts_stop * self.n_agents
+            # Keys after the tile's last timestep are fully decayed so they are skipped
+            decay_matrix = self.get_decay_matrix(dones, ts_start, ts_stop, causal_keys=True)
+            decay_matrix = decay_matrix.astype(self.dtype)
+            scores = q_proj[:, start:stop] @ k_proj[:, :, :stop]
+            inner_chunk.append((scores * decay_matrix) @ v_proj[:, :stop])
+
+        return jnp.concatenate(inner_chunk, axis=1)
+
     def recurrent(
-        self, key_n: Array, query_n: Array, value_n: Array, hstate: Array
+        self, key_n: Array, query_n: Array, value_n: Array, hstate: Array, decay_hstate: bool
     ) -> Tuple[Array, Array]:
-        """Recurrent representation of the retention mechanism."""
+        """Recurrent representation of the retention mechanism.
+
+        If `decay_hstate` is True, the hidden state is decayed by kappa before it is updated.
+        This should happen once per timestep, on the first recurrent call of that timestep.
+        """
         # Apply projection to q_proj, k_proj, v_proj
-        q_proj = query_n @ self.w_q
-        k_proj = key_n @ self.w_k
-        v_proj = value_n @ self.w_v
+        q_proj = query_n @ self.w_q.astype(self.dtype)
+        k_proj = key_n @ self.w_k.astype(self.dtype)
+        v_proj = value_n @ self.w_v.astype(self.dtype)
+
+        # Decay the hidden state where it is read for the update, rather than in a separate pass
+        if decay_hstate:
+            hstate = hstate * self.decay_kappa
 
         # Apply the retention mechanism and update the hidden state
         updated_hstate = hstate + (k_proj.transpose(0, -1, -2) @ v_proj)
@@ -114,78 +163,64 @@ class SimpleRetention(nn.Module):
 
         return ret, updated_hstate
 
-    def get_decay_matrix(self, dones: Array) -> Array:
-        """Get the decay matrix for the full sequence based on the dones and retention type."""
+    def get_decay_matrix(
+        self,
+        dones: Array,
+        ts_start: int = 0,
+        ts_stop: Optional[int] = None,
+        causal_keys: bool = False,
+    ) -> Array:
+        """Get the rows of the decay matrix for the query timesteps in [ts_start, ts_stop).
+
+        The decay between a query at timestep n and a key at timestep m is kappa^(n - m) if
+        n >= m and there was no termination in (m, n]. If there is a termination on timestep t,
+        then the decay matrix is restarted from index (t, t). See the section Adapting the decay
+        matrix for MARL for a full explanation: https://arxiv.org/pdf/2410.01706
+
+        If `causal_keys` is True, only the columns of keys up to `ts_stop` are returned, since
+        the decay is zero for every key after the last query timestep.
+        """
         # Extract done information at the timestep level
         timestep_dones = dones[:, :: self.n_agents]  # B, T
+        ts_stop = timestep_dones.shape[1] if ts_stop is None else ts_stop
+        T = ts_stop if causal_keys else timestep_dones.shape[1]
+        timestep_dones = timestep_dones[:, :T]
+
+        # Two timesteps are in the same episode if they have seen the same number of dones
+        episode_idx = jnp.cumsum(timestep_dones, axis=1)
+        same_episode = episode_idx[:, ts_start:ts_stop, jnp.newaxis] == episode_idx[:, jnp.newaxis]
+
+        # Decay based on difference in timestep indices.
+        n = jnp.arange(ts_start, ts_stop)[:, jnp.newaxis]
+        m = jnp.arange(T)[jnp.newaxis]
+        decay_matrix = (self.decay_kappa ** jnp.maximum(n - m, 0)) * (n >= m)
 
-        # B, T, T
-        timestep_mask = self._get_decay_matrix_mask_timestep(timestep_dones)
-        decay_matrix = self._get_default_decay_matrix(timestep_dones)
-        decay_matrix *= timestep_mask
+        # B, Tq, T
+        decay_matrix = decay_matrix * same_episode
 
-        # B, T, T ->  B, T * N, T * N
+        # B, Tq, T ->  B, Tq * N, T * N
         decay_matrix = jnp.repeat(
             jnp.repeat(decay_matrix, self.n_agents, axis=1), self.n_agents, axis=2
         )
 
         # Apply a causal mask over agents if full self-retention is disabled
         # This converts it from a blocked decay matrix to a causal decay matrix
-        decay_matrix = self._causal_mask(decay_matrix)
+        decay_matrix = self._causal_mask(decay_matrix, row_offset=ts_start * self.n_agents)
 
         return decay_matrix
 
-    def _causal_mask(self, matrix: Array) -> Array:
-        """Applies a causal mask to the input matrix if `masked` is True."""
+    def _causal_mask(self, matrix: Array, row_offset: int = 0) -> Array:
+        """Applies a causal mask to the input matrix if `masked` is True.
+
+        `row_offset` is the index of the matrix's first row in the full sequence.
+        """
         if self.masked:
-            mask_agents = jnp.tril(jnp.ones((matrix.shape[1], matrix.shape[1])))
+            mask_agents = jnp.tri(
+                matrix.shape[1], matrix.shape[2], k=row_offset, dtype=matrix.dtype
+            )
             matrix = mask_agents[None, :, :] * matrix
         return matrix
 
-    def _get_decay_matrix_mask_timestep(self, ts_dones: Array) -> Array:
-        """Generates a mask over the timesteps based on the done status of agents.
-
-        If there is a termination on timestep t, then the decay matrix should be
-        restarted from index (t, t). See the section Adapting the decay matrix for MARL
-        for a full explanation: https://arxiv.org/pdf/2410.01706
-        """
-        # Get the shape of the input: batch size and number of timesteps
-        B, T = ts_dones.shape
-
-        # Initialise the mask
-        timestep_mask = jnp.zeros((B, T, T), dtype=bool)
-        all_false = jnp.zeros((B, T, T), dtype=bool)
-
-        # Iterate over the timesteps and apply the mask
-        for i in range(T):
-            done_this_step = ts_dones[:, i, jnp.newaxis, jnp.newaxis]
-            ts_done_xs = all_false.at[:, i:, :].set(done_this_step)
-            ts_done_ys = all_false.at[:, :, :i].set(done_this_step)
-
-            # Combine the x and y masks to get the mask for the current timestep.
-            timestep_mask |= ts_done_xs & ts_done_ys
-
-        return ~timestep_mask
-
-    def _get_default_decay_matrix(self, dones: Array) -> Array:
-        """Compute the decay matrix without taking into account the timestep-based masking."""
-        # Get the shape of the input: batch size and number of timesteps
-        B, T = dones.shape
-
-        # Create the n and m matrices
-        n = jnp.arange(T)[:, jnp.newaxis, ...]
-        m = jnp.arange(T)[jnp.newaxis, ...]
-
-        # Decay based on difference in timestep indices.
-        decay_matrix = (self.decay_kappa ** (n - m)) * (n >= m)
-        # Replace NaN values with 0
-        decay_matrix = jnp.nan_to_num(decay_matrix)
-
-        # Adjust for batch size
-        decay_matrix = jnp.broadcast_to(decay_matrix, (B, T, T))
-
-        return decay_matrix
-
     def get_xi(self, dones: Array) -> Array:
         """Computes a decaying matrix 'xi', which decays over time until the first done signal."""
         # Get done status for each timestep by slicing out the agent dimension
@@ -222,16 +257,14 @@ class MultiScaleRetention(nn.Module):
     memory_config: DictConfig
     masked: bool = True
     decay_scaling_factor: float = 1.0
+    dtype: Any = jnp.float32  # Computation dtype, params are kept in float32
 
     def setup(self) -> None:
         assert self.embed_dim % self.n_head == 0, "embed_dim must be divisible by n_head"
         self.head_size = self.embed_dim // self.n_head
 
         # Decay kappa for each head
-        self.decay_kappas = 1 - jnp.exp(
-            jnp.linspace(jnp.log(1 / 32), jnp.log(1 / 512), self.n_head)
-        )
-        self.decay_kappas = self.decay_kappas * self.decay_scaling_factor
+        self.decay_kappas = get_decay_kappas(self.n_head, self.decay_scaling_factor)
 
         # Initialise the weights and group norm
         self.w_g = self.param(
@@ -244,7 +277,7 @@ class MultiScaleRetention(nn.Module):
             nn.initializers.normal(stddev=1 / self.embed_dim),
             (self.embed_dim, self.embed_dim),
         )
-        self.group_norm = nn.GroupNorm(num_groups=self.n_head)
+        self.group_norm = nn.GroupNorm(num_groups=self.n_head, dtype=self.dtype)
 
         # Initialise the retention mechanisms
         self.retention_heads = [
@@ -253,14 +286,20 @@ class MultiScaleRetention(nn.Module):
                 self.head_size,
                 self.n_agents,
                 self.masked,
-                decay_kappa,
+                float(decay_kappa),
                 self.memory_config,
+                dtype=self.dtype,
             )
             for decay_kappa in self.decay_kappas
         ]
 
-        # Create an instance of the positional encoding
-        self.pe = PositionalEncoding(self.embed_dim)
+        # Create an instance of the positional encoding, positions are the env step counts which
+        # lie in [0, max_timestep].
+        if self.memory_config.timestep_positional_encoding:
+            max_timestep = self.memory_config.get("max_timestep")
+            err = "memory_config.max_timestep must be set to use the timestep positional encoding"
+            assert max_timestep is not None, err
+            self.pe = PositionalEncoding(self.embed_dim, max_timestep + 1)
 
     def __call__(
         self,
@@ -272,52 +311,59 @@ class MultiScaleRetention(nn.Module):
         step_count: Array,
     ) -> Tuple[Array, Array]:
         """Chunkwise (default) representation of the multi-scale retention mechanism"""
-        B, C, _ = value.shape
-
         # Positional encoding of the current step
         if self.memory_config.timestep_positional_encoding:
             key, query, value = self.pe(key, query, value, step_count)
 
-        ret_output = jnp.zeros((B, C, self.embed_dim), dtype=value.dtype)
+        # Collect the per-head outputs and stack them once instead of scattering each head
+        head_outputs, head_hstates = [], []
         for head in range(self.n_head):
             y, new_hs = self.retention_heads[head](key, query, value, hstate[:, head], dones)
-            ret_output = ret_output.at[
-                :, :, self.head_size * head : self.head_size * (head + 1)
-            ].set(y)
-            hstate = hstate.at[:, head, :, :].set(new_hs)
+            head_outputs.append(y)
+            head_hstates.append(new_hs)
+        ret_output = jnp.concatenate(head_outputs, axis=-1)
+        hstate = jnp.stack(head_hstates, axis=1)
 
         ret_output = self.group_norm(ret_output.reshape(-1, self.head_size)).reshape(
             ret_output.shape
         )
 
         x = key
-        output = (jax.nn.swish(x @ self.w_g) * ret_output) @ self.w_o
+        output = (jax.nn.swish(x @ self.w_g.astype(self.dtype)) * ret_output) @ self.w_o.astype(
+            self.dtype
+        )
         return output, hstate
 
     def recurrent(
-        self, key_n: Array, query_n: Array, value_n: Array, hstate: Array, step_count: Array
+        self,
+        key_n: Array,
+        query_n: Array,
+        value_n: Array,
+        hstate: Array,
+        step_count: Array,
+        decay_hstate: bool = False,
     ) -> Tuple[Array, Array]:
         """Recurrent representation of the multi-scale retention mechanism"""
-        B, S, _ = value_n.shape
-
         # Positional encoding of the current step if enabled
         if self.memory_config.timestep_positional_encoding:
             key_n, query_n, value_n = self.pe(key_n, query_n, value_n, step_count)
 
-        ret_output = jnp.zeros((B, S, self.embed_dim), dtype=value_n.dtype)
+        head_outputs, head_hstates = [], []
         for head in range(self.n_head):
             y, new_hs = self.retention_heads[head].recurrent(
-                key_n, query_n, value_n, hstate[:, head]
+                key_n, query_n, value_n, hstate[:, head], decay_hstate
             )
-            ret_output = ret_output.at[
-                :, :, self.head_size * head : self.head_size * (head + 1)
-            ].set(y)
-            hstate = hstate.at[:, head, :, :].set(new_hs)
+            head_outputs.append(y)
+            head_hstates.append(new_hs)
+        ret_output = jnp.concatenate(head_outputs, axis=-1)
+        hstate = jnp.stack(head_hstates, axis=1)
 
         ret_output = self.group_norm(ret_output.reshape(-1, self.head_size)).reshape(
             ret_output.shape
         )
 
         x = key_n
-        output = (jax.nn.swish(x @ self.w_g) * ret_output) @ self.w_o
+        output = (jax.nn.swish(x @ self.w_g.astype(self.dtype)) * ret_output) @ self.w_o.astype(
+            self.dtype
+        )
         return output, hstate
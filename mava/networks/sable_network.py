@@ -13,17 +13,17 @@
 # limitations under the License.
 
 from functools import partial
-from typing import Optional, Tuple
+from typing import Any, Callable, Optional, Tuple
 
 import chex
+import jax
 import jax.numpy as jnp
 from flax import linen as nn
 from flax.linen.initializers import orthogonal
-from jax import tree
 from omegaconf import DictConfig
 
 from mava.networks.retention import MultiScaleRetention
-from mava.networks.torsos import SwiGLU
+from mava.networks.torsos import FusedRMSNorm, SwiGLU
 from mava.networks.utils.sable import (
     act_encoder_fn,
     continuous_autoregressive_act,
@@ -36,6 +36,33 @@ from mava.systems.sable.types import HiddenStates, SableNetworkConfig
 from mava.types import Observation
 from mava.utils.network_utils import _CONTINUOUS, _DISCRETE
 
+# Axis of the hidden states that indexes the blocks: (B, n_head, n_block, head_size, head_size)
+_BLOCK_AXIS = 2
+
+
+def _scan_blocks(
+    block_fn: Callable[[nn.Module, chex.Array, Any], Tuple[chex.Array, Any]],
+    blocks: nn.Module,
+    x: chex.Array,
+    hstates: Any,
+    n_block: int,
+) -> Tuple[chex.Array, Any]:
+    """Applies `block_fn(block, x, hstate)` for `n_block` blocks in sequence with `nn.scan`.
+
+    The block's output is the scan carry, the params of each block are stacked on a leading axis
+    and the hidden states are scanned over and stacked along `_BLOCK_AXIS`. Modules that
+    `block_fn` closes over (such as a norm shared by all blocks) are not stacked.
+    """
+    scan = nn.scan(
+        block_fn,
+        variable_axes={"params": 0},
+        split_rngs={"params": True},
+        in_axes=_BLOCK_AXIS,
+        out_axes=_BLOCK_AXIS,
+        length=n_block,
+    )
+    return scan(blocks, x, hstates)
+
 
 class EncodeBlock(nn.Module):
     """Sable encoder block."""
@@ -43,10 +70,11 @@ class EncodeBlock(nn.Module):
     net_config: SableNetworkConfig
     memory_config: DictConfig
     n_agents: int
+    dtype: Any = jnp.float32
 
     def setup(self) -> None:
-        self.ln1 = nn.RMSNorm()
-        self.ln2 = nn.RMSNorm()
+        self.ln1 = FusedRMSNorm(dtype=self.dtype)
+        self.ln2 = FusedRMSNorm(dtype=self.dtype)
 
         self.retn = MultiScaleRetention(
             embed_dim=self.net_config.embed_dim,
@@ -55,9 +83,10 @@ class EncodeBlock(nn.Module):
             masked=False,  # Full retention for the encoder
             memory_config=self.memory_config,
             decay_scaling_factor=self.memory_config.decay_scaling_factor,
+            dtype=self.dtype,
         )
 
-        self.ffn = SwiGLU(self.net_config.embed_dim, self.net_config.embed_dim)
+        self.ffn = SwiGLU(self.net_config.embed_dim, self.net_config.embed_dim, dtype=self.dtype)
 
     def __call__(
         self, x: chex.Array, hstate: chex.Array, dones: chex.Array, step_count: chex.Array
@@ -70,10 +99,17 @@ class EncodeBlock(nn.Module):
         output = self.ln2(x + self.ffn(x))
         return output, updated_hstate
 
-    def recurrent(self, x: chex.Array, hstate: chex.Array, step_count: chex.Array) -> chex.Array:
+    def recurrent(
+        self, x: chex.Array, hstate: chex.Array, step_count: chex.Array, decay_hstate: bool
+    ) -> chex.Array:
         """Applies Recurrent MultiScaleRetention."""
         ret, updated_hstate = self.retn.recurrent(
-            key_n=x, query_n=x, value_n=x, hstate=hstate, step_count=step_count
+            key_n=x,
+            query_n=x,
+            value_n=x,
+            hstate=hstate,
+            step_count=step_count,
+            decay_hstate=decay_hstate,
         )
         x = self.ln1(x + ret)
         output = self.ln2(x + self.ffn(x))
@@ -81,20 +117,26 @@ class EncodeBlock(nn.Module):
 
 
 class Encoder(nn.Module):
-    """Multi-block encoder consisting of multiple `EncoderBlock` modules."""
+    """Multi-block encoder consisting of multiple `EncoderBlock` modules.
+
+    The blocks compute in `dtype`, while the value head and the returned hidden state stay in
+    float32.
+    """
 
     net_config: SableNetworkConfig
     memory_config: DictConfig
     n_agents: int
+    dtype: Any = jnp.float32
 
     def setup(self) -> None:
-        self.ln = nn.RMSNorm()
-
         self.obs_encoder = nn.Sequential(
             [
-                nn.RMSNorm(),
+                FusedRMSNorm(dtype=self.dtype),
                 nn.Dense(
-                    self.net_config.embed_dim, kernel_init=orthogonal(jnp.sqrt(2)), use_bias=False
+                    self.net_config.embed_dim,
+                    kernel_init=orthogonal(jnp.sqrt(2)),
+                    use_bias=False,
+                    dtype=self.dtype,
                 ),
                 nn.gelu,
             ],
@@ -103,57 +145,69 @@ class Encoder(nn.Module):
             [
                 nn.Dense(self.net_config.embed_dim, kernel_init=orthogonal(jnp.sqrt(2))),
                 nn.gelu,
-                nn.RMSNorm(),
+                FusedRMSNorm(),
                 nn.Dense(1, kernel_init=orthogonal(0.01)),
             ],
         )
 
-        self.blocks = [
-            EncodeBlock(
-                self.net_config,
-                self.memory_config,
-                self.n_agents,
-                name=f"encoder_block_{block_id}",
-            )
-            for block_id in range(self.net_config.n_block)
-        ]
+        # Norm applied to the input of every block, shared by all blocks. It cannot be hoisted
+        # before the first block: each block's output is rescaled by that block's own `ln2`
+        # scale, so every block input is renormalised. `_scan_blocks` closes over it, so it is
+        # applied inside the scanned body where it fuses with the retention projections.
+        self.ln = FusedRMSNorm(dtype=self.dtype)
+        # A single block scanned `n_block` times with `_scan_blocks`.
+        self.blocks = EncodeBlock(
+            self.net_config, self.memory_config, self.n_agents, self.dtype, name="encoder_blocks"
+        )
 
     def __call__(
         self, obs: chex.Array, hstate: chex.Array, dones: chex.Array, step_count: chex.Array
     ) -> Tuple[chex.Array, chex.Array, chex.Array]:
         """Apply chunkwise encoding."""
-        updated_hstate = jnp.zeros_like(hstate)
         obs_rep = self.obs_encoder(obs)
 
-        # Apply the encoder blocks
-        for i, block in enumerate(self.blocks):
-            hs = hstate[:, :, i]  # Get the hidden state for the current block
-            # Apply the chunkwise encoder block
-            obs_rep, hs_new = block(self.ln(obs_rep), hs, dones, step_count)
-            updated_hstate = updated_hstate.at[:, :, i].set(hs_new)
+        # Apply the chunkwise encoder blocks
+        def _block(
+            block: EncodeBlock, x: chex.Array, hs: chex.Array
+        ) -> Tuple[chex.Array, chex.Array]:
+            return block(self.ln(x), hs, dones, step_count)
+
+        obs_rep, updated_hstate = _scan_blocks(
+            _block, self.blocks, obs_rep, hstate.astype(self.dtype), self.net_config.n_block
+        )
 
-        value = self.head(obs_rep)
+        value = self.head(obs_rep.astype(jnp.float32))
 
-        return value, obs_rep, updated_hstate
+        return value, obs_rep, updated_hstate.astype(hstate.dtype)
 
     def recurrent(
-        self, obs: chex.Array, hstate: chex.Array, step_count: chex.Array
+        self,
+        obs: chex.Array,
+        hstate: chex.Array,
+        step_count: chex.Array,
+        decay_hstate: bool = False,
     ) -> Tuple[chex.Array, chex.Array, chex.Array]:
-        """Apply recurrent encoding."""
-        updated_hstate = jnp.zeros_like(hstate)
+        """Apply recurrent encoding.
+
+        If `decay_hstate` is True, the hidden state is decayed by kappa before it is used, which
+        should happen on the first recurrent call of each timestep.
+        """
         obs_rep = self.obs_encoder(obs)
 
-        # Apply the encoder blocks
-        for i, block in enumerate(self.blocks):
-            hs = hstate[:, :, i]  # Get the hidden state for the current block
-            # Apply the recurrent encoder block
-            obs_rep, hs_new = block.recurrent(self.ln(obs_rep), hs, step_count)
-            updated_hstate = updated_hstate.at[:, :, i].set(hs_new)
+        # Apply the recurrent encoder blocks
+        def _block(
+            block: EncodeBlock, x: chex.Array, hs: chex.Array
+        ) -> Tuple[chex.Array, chex.Array]:
+            return block.recurrent(self.ln(x), hs, step_count, decay_hstate)
+
+        obs_rep, updated_hstate = _scan_blocks(
+            _block, self.blocks, obs_rep, hstate.astype(self.dtype), self.net_config.n_block
+        )
 
         # Compute the value function
-        value = self.head(obs_rep)
+        value = self.head(obs_rep.astype(jnp.float32))
 
-        return value, obs_rep, updated_hstate
+        return value, obs_rep, updated_hstate.astype(hstate.dtype)
 
 
 class DecodeBlock(nn.Module):
@@ -162,9 +216,12 @@ class DecodeBlock(nn.Module):
     net_config: SableNetworkConfig
     memory_config: DictConfig
     n_agents: int
+    dtype: Any = jnp.float32
 
     def setup(self) -> None:
-        self.ln1, self.ln2, self.ln3 = nn.RMSNorm(), nn.RMSNorm(), nn.RMSNorm()
+        self.ln1 = FusedRMSNorm(dtype=self.dtype)
+        self.ln2 = FusedRMSNorm(dtype=self.dtype)
+        self.ln3 = FusedRMSNorm(dtype=self.dtype)
 
         self.retn1 = MultiScaleRetention(
             embed_dim=self.net_config.embed_dim,
@@ -173,6 +230,7 @@ class DecodeBlock(nn.Module):
             masked=True,  # Masked retention for the decoder
             memory_config=self.memory_config,
             decay_scaling_factor=self.memory_config.decay_scaling_factor,
+            dtype=self.dtype,
         )
         self.retn2 = MultiScaleRetention(
             embed_dim=self.net_config.embed_dim,
@@ -181,9 +239,10 @@ class DecodeBlock(nn.Module):
             masked=True,  # Masked retention for the decoder
             memory_config=self.memory_config,
             decay_scaling_factor=self.memory_config.decay_scaling_factor,
+            dtype=self.dtype,
         )
 
-        self.ffn = SwiGLU(self.net_config.embed_dim, self.net_config.embed_dim)
+        self.ffn = SwiGLU(self.net_config.embed_dim, self.net_config.embed_dim, dtype=self.dtype)
 
     def __call__(
         self,
@@ -222,19 +281,30 @@ class DecodeBlock(nn.Module):
         obs_rep: chex.Array,
         hstates: Tuple[chex.Array, chex.Array],
         step_count: chex.Array,
+        decay_hstate: bool,
     ) -> Tuple[chex.Array, Tuple[chex.Array, chex.Array]]:
         """Applies Recurrent MultiScaleRetention."""
         hs1, hs2 = hstates
 
         # Apply the self-retention over actions
         ret, hs1_new = self.retn1.recurrent(
-            key_n=x, query_n=x, value_n=x, hstate=hs1, step_count=step_count
+            key_n=x,
+            query_n=x,
+            value_n=x,
+            hstate=hs1,
+            step_count=step_count,
+            decay_hstate=decay_hstate,
         )
         ret = self.ln1(x + ret)
 
         # Apply the cross-retention over obs x action
         ret2, hs2_new = self.retn2.recurrent(
-            key_n=ret, query_n=obs_rep, value_n=ret, hstate=hs2, step_count=step_count
+            key_n=ret,
+            query_n=obs_rep,
+            value_n=ret,
+            hstate=hs2,
+            step_count=step_count,
+            decay_hstate=decay_hstate,
         )
         y = self.ln2(obs_rep + ret2)
         output = self.ln3(y + self.ffn(y))
@@ -243,16 +313,21 @@ class DecodeBlock(nn.Module):
 
 
 class Decoder(nn.Module):
-    """Multi-block decoder consisting of multiple `DecoderBlock` modules."""
+    """Multi-block decoder consisting of multiple `DecoderBlock` modules.
+
+    The blocks compute in `dtype`, while the action head and the returned hidden states stay in
+    float32.
+    """
 
     net_config: SableNetworkConfig
     memory_config: DictConfig
     n_agents: int
     action_dim: int
     action_space_type: str = _DISCRETE
+    dtype: Any = jnp.float32
 
     def setup(self) -> None:
-        self.ln = nn.RMSNorm()
+        self.ln = FusedRMSNorm(dtype=self.dtype)
 
         use_bias = self.action_space_type == _CONTINUOUS
         self.action_encoder = nn.Sequential(
@@ -261,6 +336,7 @@ class Decoder(nn.Module):
                     self.net_config.embed_dim,
                     use_bias=use_bias,
                     kernel_init=orthogonal(jnp.sqrt(2)),
+                    dtype=self.dtype,
                 ),
                 nn.gelu,
             ],
@@ -278,20 +354,15 @@ class Decoder(nn.Module):
             [
                 nn.Dense(self.net_config.embed_dim, kernel_init=orthogonal(jnp.sqrt(2))),
                 nn.gelu,
-                nn.RMSNorm(),
+                FusedRMSNorm(),
                 nn.Dense(self.action_dim, kernel_init=orthogonal(0.01)),
             ],
         )
 
-        self.blocks = [
-            DecodeBlock(
-                self.net_config,
-                self.memory_config,
-                self.n_agents,
-                name=f"decoder_block_{block_id}",
-            )
-            for block_id in range(self.net_config.n_block)
-        ]
+        # A single block scanned `n_block` times with `_scan_blocks`.
+        self.blocks = DecodeBlock(
+            self.net_config, self.memory_config, self.n_agents, self.dtype, name="decoder_blocks"
+        )
 
     def __call__(
         self,
@@ -302,21 +373,24 @@ class Decoder(nn.Module):
         step_count: chex.Array,
     ) -> Tuple[chex.Array, Tuple[chex.Array, chex.Array]]:
         """Apply chunkwise decoding."""
-        updated_hstates = tree.map(jnp.zeros_like, hstates)
         action_embeddings = self.action_encoder(action)
         x = self.ln(action_embeddings)
 
-        # Apply the decoder blocks
-        for i, block in enumerate(self.blocks):
-            hs = tree.map(lambda x, j=i: x[:, :, j], hstates)
-            x, hs_new = block(x=x, obs_rep=obs_rep, hstates=hs, dones=dones, step_count=step_count)
-            updated_hstates = tree.map(
-                lambda x, y, j=i: x.at[:, :, j].set(y), updated_hstates, hs_new
-            )
+        # Apply the chunkwise decoder blocks
+        obs_rep = obs_rep.astype(self.dtype)
+
+        def _block(
+            block: DecodeBlock, x: chex.Array, hs: Tuple[chex.Array, chex.Array]
+        ) -> Tuple[chex.Array, Tuple[chex.Array, chex.Array]]:
+            return block(x, obs_rep, hs, dones, step_count)
+
+        x, updated_hstates = _scan_blocks(
+            _block, self.blocks, x, self._cast(hstates, self.dtype), self.net_config.n_block
+        )
 
-        logit = self.head(x)
+        logit = self.head(x.astype(jnp.float32))
 
-        return logit, updated_hstates
+        return logit, self._cast(updated_hstates, hstates[0].dtype)
 
     def recurrent(
         self,
@@ -324,23 +398,35 @@ class Decoder(nn.Module):
         obs_rep: chex.Array,
         hstates: Tuple[chex.Array, chex.Array],
         step_count: chex.Array,
+        decay_hstate: bool = False,
     ) -> Tuple[chex.Array, Tuple[chex.Array, chex.Array]]:
-        """Apply recurrent decoding."""
-        updated_hstates = tree.map(jnp.zeros_like, hstates)
+        """Apply recurrent decoding.
+
+        If `decay_hstate` is True, the hidden states are decayed by kappa before they are used,
+        which should happen on the first recurrent call of each timestep.
+        """
         action_embeddings = self.action_encoder(action)
         x = self.ln(action_embeddings)
 
-        # Apply the decoder blocks
-        for i, block in enumerate(self.blocks):
-            hs = tree.map(lambda x, i=i: x[:, :, i], hstates)
-            x, hs_new = block.recurrent(x=x, obs_rep=obs_rep, hstates=hs, step_count=step_count)
-            updated_hstates = tree.map(
-                lambda x, y, j=i: x.at[:, :, j].set(y), updated_hstates, hs_new
-            )
+        # Apply the recurrent decoder blocks
+        obs_rep = obs_rep.astype(self.dtype)
+
+        def _block(
+            block: DecodeBlock, x: chex.Array, hs: Tuple[chex.Array, chex.Array]
+        ) -> Tuple[chex.Array, Tuple[chex.Array, chex.Array]]:
+            return block.recurrent(x, obs_rep, hs, step_count, decay_hstate)
+
+        x, updated_hstates = _scan_blocks(
+            _block, self.blocks, x, self._cast(hstates, self.dtype), self.net_config.n_block
+        )
+
+        logit = self.head(x.astype(jnp.float32))
 
-        logit = self.head(x)
+        return logit, self._cast(updated_hstates, hstates[0].dtype)
 
-        return logit, updated_hstates
+    @staticmethod
+    def _cast(hstates: Tuple[chex.Array, chex.Array], dtype: Any) -> Tuple[chex.Array, chex.Array]:
+        return jax.tree.map(lambda hs: hs.astype(dtype), hstates)
 
 
 class SableNetwork(nn.Module):
@@ -362,17 +448,17 @@ class SableNetwork(nn.Module):
             and self.memory_config.decay_scaling_factor <= 1
         ), "Decay scaling factor should be between 0 and 1"
 
-        # Decay kappa for each head
-        self.decay_kappas = 1 - jnp.exp(
-            jnp.linspace(jnp.log(1 / 32), jnp.log(1 / 512), self.net_config.n_head)
+        # With mixed precision the retention blocks compute in bfloat16, while the params, the
+        # norm statistics, the output heads and the stored hidden states stay in float32.
+        self.compute_dtype = (
+            jnp.bfloat16 if self.memory_config.get("mixed_precision", False) else jnp.float32
         )
-        self.decay_kappas = self.decay_kappas * self.memory_config.decay_scaling_factor
-        self.decay_kappas = self.decay_kappas[None, :, None, None, None]
 
         self.encoder = Encoder(
             self.net_config,
             self.memory_config,
             self.n_agents_per_chunk,
+            dtype=self.compute_dtype,
         )
         self.decoder = Decoder(
             self.net_config,
@@ -380,6 +466,7 @@ class SableNetwork(nn.Module):
             self.n_agents_per_chunk,
             self.action_dim,
             self.action_space_type,
+            dtype=self.compute_dtype,
         )
 
         # Set the actor and trainer functions
@@ -454,13 +541,12 @@ class SableNetwork(nn.Module):
             observation.step_count,
         )
 
-        # Decay the hidden states: each timestep we decay the hidden states once
-        decayed_hstates = tree.map(lambda x: x * self.decay_kappas, hstates)
-
+        # Each timestep the hidden states are decayed once, by the first recurrent retention
+        # update of that timestep in the encoder and in the decoder.
         value, obs_rep, updated_enc_hs = self.act_encoder_fn(
             encoder=self.encoder,
             obs=obs,
-            decayed_hstate=decayed_hstates[0],
+            hstate=hstates[0],
             step_count=step_count,
         )
 
@@ -468,7 +554,7 @@ class SableNetwork(nn.Module):
             decoder=self.decoder,
             obs_rep=obs_rep,
             legal_actions=legal_actions,
-            hstates=decayed_hstates[1:],
+            hstates=hstates[1:],
             step_count=step_count,
             key=key,
         )
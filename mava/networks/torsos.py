@@ -12,10 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Callable, Dict, Sequence
+from typing import Any, Callable, Dict, Sequence
 
 import chex
 import jax
+import jax.numpy as jnp
 import numpy as np
 from flax import linen as nn
 from flax.linen.initializers import orthogonal
@@ -84,6 +85,7 @@ class SwiGLU(nn.Module):
 
     hidden_dim: int
     embed_dim: int
+    dtype: Any = jnp.float32  # Computation dtype, params are kept in float32
 
     def setup(self) -> None:
         self.W_linear = self.param(
@@ -95,8 +97,30 @@ class SwiGLU(nn.Module):
         )
 
     def __call__(self, x: chex.Array) -> chex.Array:
-        gated_output = jax.nn.swish(x @ self.W_gate) * (x @ self.W_linear)
-        return gated_output @ self.W_output
+        x = x.astype(self.dtype)
+        gated_output = jax.nn.swish(x @ self.W_gate.astype(self.dtype)) * (
+            x @ self.W_linear.astype(self.dtype)
+        )
+        return gated_output @ self.W_output.astype(self.dtype)
+
+
+class FusedRMSNorm(nn.Module):
+    """RMSNorm written as a single rsqrt and multiply.
+
+    Equivalent to `nn.RMSNorm` with the same `scale` parameter, but simple enough for XLA to fuse
+    with the residual add that usually precedes it and the projection that follows it.
+    The statistics are always computed in float32 and the output is cast to `dtype`.
+    """
+
+    eps: float = 1e-6
+    dtype: Any = jnp.float32
+
+    @nn.compact
+    def __call__(self, x: chex.Array) -> chex.Array:
+        scale = self.param("scale", nn.initializers.ones, (x.shape[-1],))
+        x = x.astype(jnp.float32)
+        x = x * jax.lax.rsqrt(jnp.mean(x * x, axis=-1, keepdims=True) + self.eps) * scale
+        return x.astype(self.dtype)
 
 
 def _parse_activation_fn(activation_fn_name: str) -> Callable[[chex.Array], chex.Array]:
@@ -0,0 +1,58 @@
+# Copyright 2022 InstaDeep Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Any, Callable, Tuple
+
+import chex
+import jax.numpy as jnp
+from flax import linen as nn
+from jax import tree
+
+
+def scan_chunks(
+    fn: Callable[[nn.Module, Any, Any], Tuple[Any, Any]],
+    module: nn.Module,
+    carry: Any,
+    xs: Any,
+    chunk_size: int,
+) -> Tuple[Any, Any]:
+    """Applies `fn(module, carry, chunk) -> (carry, ys)` to consecutive chunks of a sequence.
+
+    Every leaf of `xs` is split into chunks of `chunk_size` along its sequence axis (axis 1) and
+    the chunks are scanned over with a single traced copy of `fn`, instead of unrolling one copy
+    per chunk. The `ys` of every chunk are concatenated back along the sequence axis.
+    """
+    seq_len = tree.leaves(xs)[0].shape[1]
+    num_chunks = seq_len // chunk_size
+
+    def to_chunks(x: chex.Array) -> chex.Array:
+        # (B, S, ...) -> (num_chunks, B, chunk_size, ...)
+        x = x.reshape(x.shape[0], num_chunks, chunk_size, *x.shape[2:])
+        return jnp.swapaxes(x, 0, 1)
+
+    def from_chunks(y: chex.Array) -> chex.Array:
+        # (num_chunks, B, chunk_size, ...) -> (B, S, ...)
+        y = jnp.swapaxes(y, 0, 1)
+        return y.reshape(y.shape[0], num_chunks * chunk_size, *y.shape[3:])
+
+    # The params are shared by every chunk
+    scan_fn = nn.scan(
+        fn,
+        variable_broadcast="params",
+        split_rngs={"params": False},
+        length=num_chunks,
+    )
+    carry, ys = scan_fn(module, carry, tree.map(to_chunks, xs))
+
+    return carry, tree.map(from_chunks, ys)
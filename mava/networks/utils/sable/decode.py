@@ -22,6 +22,7 @@ import tensorflow_probability.substrates.jax.distributions as tfd
 from flax import linen as nn
 
 from mava.networks.distributions import TanhTransformedDistribution
+from mava.networks.utils.sable.chunking import scan_chunks
 
 # General shapes legend:
 # B: batch size
@@ -33,6 +34,21 @@ from mava.networks.distributions import TanhTransformedDistribution
 _MIN_SCALE = 1e-3
 
 
+def _decode_chunk(
+    decoder: nn.Module, hstates: chex.Array, chunk: Tuple[chex.Array, ...]
+) -> Tuple[chex.Array, chex.Array]:
+    """Chunkwise decoding of a single chunk of shifted actions."""
+    chunk_shifted_actions, chunked_obs_rep, chunk_dones, chunk_step_count = chunk
+    chunk_output, hstates = decoder(
+        action=chunk_shifted_actions,
+        obs_rep=chunked_obs_rep,
+        hstates=hstates,
+        dones=chunk_dones,
+        step_count=chunk_step_count,
+    )
+    return hstates, chunk_output
+
+
 def discrete_train_decoder_fn(
     decoder: nn.Module,
     obs_rep: chex.Array,
@@ -50,26 +66,11 @@ def discrete_train_decoder_fn(
     del rng_key
 
     shifted_actions = get_shifted_discrete_actions(action, legal_actions, n_agents=n_agents)
-    logit = jnp.zeros_like(legal_actions, dtype=jnp.float32)
 
     # Apply the decoder per chunk
-    num_chunks = shifted_actions.shape[1] // chunk_size
-    for chunk_id in range(0, num_chunks):
-        start_idx = chunk_id * chunk_size
-        end_idx = (chunk_id + 1) * chunk_size
-        # Chunk obs_rep, shifted_actions, dones, and step_count
-        chunked_obs_rep = obs_rep[:, start_idx:end_idx]
-        chunk_shifted_actions = shifted_actions[:, start_idx:end_idx]
-        chunk_dones = dones[:, start_idx:end_idx]
-        chunk_step_count = step_count[:, start_idx:end_idx]
-        chunk_logit, hstates = decoder(
-            action=chunk_shifted_actions,
-            obs_rep=chunked_obs_rep,
-            hstates=hstates,
-            dones=chunk_dones,
-            step_count=chunk_step_count,
-        )
-        logit = logit.at[:, start_idx:end_idx].set(chunk_logit)
+    hstates, logit = scan_chunks(
+        _decode_chunk, decoder, hstates, (shifted_actions, obs_rep, dones, step_count), chunk_size
+    )
 
     masked_logits = jnp.where(
         legal_actions,
@@ -121,8 +122,8 @@ def discrete_autoregressive_act(
     shifted_actions = jnp.zeros((B, N, A + 1))
     shifted_actions = shifted_actions.at[:, 0, 0].set(1)
 
-    output_action = jnp.zeros((B, N, 1))
-    output_action_log = jnp.zeros_like(output_action)
+    # Collect the per-agent outputs and concatenate them once instead of scattering into zeros
+    output_actions, output_action_logs = [], []
 
     # Apply the decoder autoregressively
     for i in range(N):
@@ -131,6 +132,7 @@ def discrete_autoregressive_act(
             obs_rep=obs_rep[:, i : i + 1, :],
             hstates=hstates,
             step_count=step_count[:, i : i + 1],
+            decay_hstate=i == 0,  # Decay the hidden states once per timestep
         )
         masked_logits = jnp.where(
             legal_actions[:, i : i + 1, :],
@@ -140,17 +142,16 @@ def discrete_autoregressive_act(
         distribution = distrax.Categorical(logits=masked_logits)
         key, sample_key = jax.random.split(key)
         action, action_log = distribution.sample_and_log_prob(seed=sample_key)
-        output_action = output_action.at[:, i, :].set(action)
-        output_action_log = output_action_log.at[:, i, :].set(action_log)
+        output_actions.append(action)
+        output_action_logs.append(action_log)
 
         # Adds all except the last action to shifted_actions, as it is out of range.
         shifted_actions = shifted_actions.at[:, i + 1, 1:].set(
             jax.nn.one_hot(action[:, 0], A), mode="drop"
         )
-    output_actions = output_action.astype(jnp.int32)
-    output_actions = jnp.squeeze(output_actions, axis=-1)
-    output_action_log = jnp.squeeze(output_action_log, axis=-1)
-    return output_actions, output_action_log, hstates
+    output_action = jnp.concatenate(output_actions, axis=1).astype(jnp.int32)
+    output_action_log = jnp.concatenate(output_action_logs, axis=1)
+    return output_action, output_action_log, hstates
 
 
 def continuous_train_decoder_fn(
@@ -170,28 +171,12 @@ def continuous_train_decoder_fn(
     # Delete `legal_actions` since it is not used in continuous action space
     del legal_actions
 
-    B, S, _ = action.shape
     shifted_actions = get_shifted_continuous_actions(action, action_dim, n_agents=n_agents)
-    act_mean = jnp.zeros((B, S, action_dim), dtype=jnp.float32)
 
     # Apply the decoder per chunk
-    num_chunks = shifted_actions.shape[1] // chunk_size
-    for chunk_id in range(0, num_chunks):
-        start_idx = chunk_id * chunk_size
-        end_idx = (chunk_id + 1) * chunk_size
-        # Chunk obs_rep, shifted_actions, dones, and step_count
-        chunked_obs_rep = obs_rep[:, start_idx:end_idx]
-        chunk_shifted_actions = shifted_actions[:, start_idx:end_idx]
-        chunk_dones = dones[:, start_idx:end_idx]
-        chunk_step_count = step_count[:, start_idx:end_idx]
-        chunked_act_mean, hstates = decoder(
-            action=chunk_shifted_actions,
-            obs_rep=chunked_obs_rep,
-            hstates=hstates,
-            dones=chunk_dones,
-            step_count=chunk_step_count,
-        )
-        act_mean = act_mean.at[:, start_idx:end_idx].set(chunked_act_mean)
+    hstates, act_mean = scan_chunks(
+        _decode_chunk, decoder, hstates, (shifted_actions, obs_rep, dones, step_count), chunk_size
+    )
 
     action_std = jax.nn.softplus(decoder.log_std) + _MIN_SCALE
 
@@ -235,8 +220,7 @@ def continuous_autoregressive_act(
 
     B, N = step_count.shape
     shifted_actions = jnp.zeros((B, N, action_dim))
-    output_action = jnp.zeros((B, N, action_dim))
-    output_action_log = jnp.zeros((B, N))
+    output_actions, output_action_logs = [], []
 
     # Apply the decoder autoregressively
     for i in range(N):
@@ -245,6 +229,7 @@ def continuous_autoregressive_act(
             obs_rep=obs_rep[:, i : i + 1, :],
             hstates=hstates,
             step_count=step_count[:, i : i + 1],
+            decay_hstate=i == 0,  # Decay the hidden states once per timestep
         )
         action_std = jax.nn.softplus(decoder.log_std) + _MIN_SCALE
 
@@ -260,9 +245,11 @@ def continuous_autoregressive_act(
         action = distribution.sample(seed=sample_key)
         action_log = distribution.log_prob(action)
 
-        output_action = output_action.at[:, i, :].set(action[:, i, :])
-        output_action_log = output_action_log.at[:, i].set(action_log[:, i])
+        output_actions.append(action)
+        output_action_logs.append(action_log)
         # Adds all except the last action to shifted_actions, as it is out of range
         shifted_actions = shifted_actions.at[:, i + 1, :].set(action[:, i, :], mode="drop")
 
+    output_action = jnp.concatenate(output_actions, axis=1)
+    output_action_log = jnp.concatenate(output_action_logs, axis=1)
     return output_action, output_action_log, hstates
@@ -18,12 +18,23 @@ import chex
 import jax.numpy as jnp
 from flax import linen as nn
 
+from mava.networks.utils.sable.chunking import scan_chunks
+
 # General shapes legend:
 # B: batch size
 # S: sequence length
 # C: number of agents per chunk of sequence
 
 
+def _encode_chunk(
+    encoder: nn.Module, hstate: chex.Array, chunk: Tuple[chex.Array, ...]
+) -> Tuple[chex.Array, Tuple[chex.Array, chex.Array]]:
+    """Chunkwise encoding of a single chunk of observations."""
+    chunk_obs, chunk_dones, chunk_step_count = chunk
+    chunk_v_loc, chunk_obs_rep, hstate = encoder(chunk_obs, hstate, chunk_dones, chunk_step_count)
+    return hstate, (chunk_v_loc, chunk_obs_rep)
+
+
 def train_encoder_fn(
     encoder: nn.Module,
     obs: chex.Array,
@@ -33,24 +44,10 @@ def train_encoder_fn(
     chunk_size: int,
 ) -> Tuple[chex.Array, chex.Array, chex.Array]:
     """Chunkwise encoding for discrete action spaces."""
-    B, S = obs.shape[:2]
-    v_loc = jnp.zeros((B, S, 1))
-    obs_rep = jnp.zeros((B, S, encoder.net_config.embed_dim))
-
     # Apply the encoder per chunk
-    num_chunks = S // chunk_size
-    for chunk_id in range(0, num_chunks):
-        start_idx = chunk_id * chunk_size
-        end_idx = (chunk_id + 1) * chunk_size
-        # Chunk obs, dones, and step_count
-        chunk_obs = obs[:, start_idx:end_idx]
-        chunk_dones = dones[:, start_idx:end_idx]
-        chunk_step_count = step_count[:, start_idx:end_idx]
-        chunk_v_loc, chunk_obs_rep, hstate = encoder(
-            chunk_obs, hstate, chunk_dones, chunk_step_count
-        )
-        v_loc = v_loc.at[:, start_idx:end_idx].set(chunk_v_loc)
-        obs_rep = obs_rep.at[:, start_idx:end_idx].set(chunk_obs_rep)
+    hstate, (v_loc, obs_rep) = scan_chunks(
+        _encode_chunk, encoder, hstate, (obs, dones, step_count), chunk_size
+    )
 
     return v_loc, obs_rep, hstate
 
@@ -58,14 +55,13 @@ def train_encoder_fn(
 def act_encoder_fn(
     encoder: nn.Module,
     obs: chex.Array,
-    decayed_hstate: chex.Array,
+    hstate: chex.Array,
     step_count: chex.Array,
     chunk_size: int,
 ) -> Tuple[chex.Array, chex.Array, chex.Array]:
     """Chunkwise encoding for ff-Sable and for discrete action spaces."""
-    B, C = obs.shape[:2]
-    v_loc = jnp.zeros((B, C, 1))
-    obs_rep = jnp.zeros((B, C, encoder.net_config.embed_dim))
+    C = obs.shape[1]
+    v_locs, obs_reps = [], []
 
     # Apply the encoder per chunk
     num_chunks = C // chunk_size
@@ -75,10 +71,15 @@ def act_encoder_fn(
         # Chunk obs and step_count
         chunk_obs = obs[:, start_idx:end_idx]
         chunk_step_count = step_count[:, start_idx:end_idx]
-        chunk_v_loc, chunk_obs_rep, decayed_hstate = encoder.recurrent(
-            chunk_obs, decayed_hstate, chunk_step_count
+        # The hidden state is decayed once per timestep: on the first chunk of agents
+        chunk_v_loc, chunk_obs_rep, hstate = encoder.recurrent(
+            chunk_obs, hstate, chunk_step_count, decay_hstate=chunk_id == 0
         )
-        v_loc = v_loc.at[:, start_idx:end_idx].set(chunk_v_loc)
-        obs_rep = obs_rep.at[:, start_idx:end_idx].set(chunk_obs_rep)
+        v_locs.append(chunk_v_loc)
+        obs_reps.append(chunk_obs_rep)
+
+    # Concatenate the chunks once instead of scattering each into a zeros buffer
+    v_loc = jnp.concatenate(v_locs, axis=1)
+    obs_rep = jnp.concatenate(obs_reps, axis=1)
 
-    return v_loc, obs_rep, decayed_hstate
+    return v_loc, obs_rep, hstate
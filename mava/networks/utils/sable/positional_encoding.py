@@ -16,29 +16,35 @@
 from typing import Tuple
 
 import chex
-import jax
 import jax.numpy as jnp
+import numpy as np
 from flax import linen as nn
 
 
 class PositionalEncoding(nn.Module):
-    """Positional Encoding for Sable. Encodes position information into sequences"""
+    """Positional Encoding for Sable. Encodes position information into sequences.
+
+    Positions must lie in [0, max_size). The encodings are looked up from a precomputed table and
+    a position outside of it means that `max_size` is misconfigured, so its encoding is NaN rather
+    than a valid encoding of another position.
+    """
 
     d_model: int
+    max_size: int
 
     def setup(self) -> None:
-        # Set maximum sequence length for positional encoding
-        self.max_size = 10_000
-        # Precompute the scaling factor for even indices (used in sine and cosine functions)
-        self.div_term = jnp.exp(
-            jnp.arange(0, self.d_model, 2) * (-jnp.log(10000.0) / self.d_model)
-        )[jnp.newaxis]
+        # Precompute the encoding of every position with numpy so that it is embedded as a
+        # constant lookup table instead of computing sin/cos at runtime.
+        self.pe_table = jnp.asarray(_sinusoidal_table(self.max_size, self.d_model))
 
     def __call__(
         self, key: chex.Array, query: chex.Array, value: chex.Array, position: chex.Array
     ) -> Tuple[chex.Array, chex.Array, chex.Array]:
         """Computes positional encoding for a given sequence of positions."""
-        pe = jax.vmap(self._get_pos_encoding)(position)
+        # Out of range positions are filled with NaN so that they fail loudly downstream instead
+        # of silently reusing the encoding of another position.
+        pe = jnp.take(self.pe_table, position, axis=0, mode="fill", fill_value=jnp.nan)
+        pe = pe.astype(key.dtype)
 
         # Add positional encoding to the input tensors
         key += pe
@@ -47,14 +53,15 @@ class PositionalEncoding(nn.Module):
 
         return key, query, value
 
-    def _get_pos_encoding(self, position: chex.Array) -> chex.Array:
-        """Computes positional encoding for a given the index of the token."""
-        seq_len = position.shape[0]
 
-        # Calculate positional encoding using sine for even indices and cosine for odd indices.
-        x = position[:, jnp.newaxis] * self.div_term
-        pe = jnp.zeros((seq_len, self.d_model))
-        pe = pe.at[:, 0::2].set(jnp.sin(x))
-        pe = pe.at[:, 1::2].set(jnp.cos(x))
+def _sinusoidal_table(max_size: int, d_model: int) -> np.ndarray:
+    """Computes the positional encoding of the positions [0, max_size)."""
+    # Scaling factor for even indices (used in sine and cosine functions)
+    div_term = np.exp(np.arange(0, d_model, 2) * (-np.log(10000.0) / d_model))
+
+    # Calculate positional encoding using sine for even indices and cosine for odd indices.
+    # Interleave them by stacking on a trailing axis rather than scattering into zeros.
+    x = np.arange(max_size)[:, np.newaxis] * div_term
+    pe = np.stack([np.sin(x), np.cos(x)], axis=-1).reshape(max_size, d_model)
 
-        return pe
+    return pe.astype(np.float32)
@@ -91,7 +91,9 @@ def get_learner_fn(
             # Step environment
             env_state, timestep = jax.vmap(env.step, in_axes=(0, 0))(env_state, action)
 
-            done = timestep.last().repeat(env.num_agents).reshape(config.arch.num_envs, -1)
+            done = jnp.broadcast_to(
+                timestep.last()[:, jnp.newaxis], (config.arch.num_envs, env.num_agents)
+            )
             transition = PPOTransition(
                 done, action, value, timestep.reward, log_prob, last_timestep.observation
             )
@@ -111,26 +113,29 @@ def get_learner_fn(
             traj_batch: PPOTransition, last_val: chex.Array
         ) -> Tuple[chex.Array, chex.Array]:
             """Calculate the GAE."""
-
-            def _get_advantages(gae_and_next_value: Tuple, transition: PPOTransition) -> Tuple:
+            gamma, gae_lambda = config.system.gamma, config.system.gae_lambda
+
+            # The TD errors do not depend on the scan carry, so they are computed for the whole
+            # rollout in one vectorised pass and only the discounted sum is scanned.
+            next_value = jnp.concatenate([traj_batch.value[1:], last_val[jnp.newaxis]])
+            not_done = 1.0 - traj_batch.done.astype(traj_batch.value.dtype)
+            delta = traj_batch.reward + gamma * next_value * not_done - traj_batch.value
+            gae_discount = gamma * gae_lambda * not_done
+
+            def _get_advantages(
+                gae: chex.Array, delta_and_discount: Tuple[chex.Array, chex.Array]
+            ) -> Tuple[chex.Array, chex.Array]:
                 """Calculate the GAE for a single transition."""
-                gae, next_value = gae_and_next_value
-                done, value, reward = (
-                    transition.done,
-                    transition.value,
-                    transition.reward,
-                )
-                gamma = config.system.gamma
-                delta = reward + gamma * next_value * (1 - done) - value
-                gae = delta + gamma * config.system.gae_lambda * (1 - done) * gae
-                return (gae, value), gae
+                delta, gae_discount = delta_and_discount
+                gae = delta + gae_discount * gae
+                return gae, gae
 
             _, advantages = jax.lax.scan(
                 _get_advantages,
-                (jnp.zeros_like(last_val), last_val),
-                traj_batch,
+                jnp.zeros_like(last_val),
+                (delta, gae_discount),
                 reverse=True,
-                unroll=16,
+                unroll=config.system.gae_unroll,
             )
             return advantages, advantages + traj_batch.value
 
@@ -157,18 +162,19 @@ def get_learner_fn(
 
                     # Calculate actor loss
                     ratio = jnp.exp(log_prob - traj_batch.log_prob)
-                    # Nomalise advantage at minibatch level
-                    gae = (gae - gae.mean()) / (gae.std() + 1e-8)
-                    actor_loss1 = ratio * gae
-                    actor_loss2 = (
-                        jnp.clip(
-                            ratio,
-                            1.0 - config.system.clip_eps,
-                            1.0 + config.system.clip_eps,
-                        )
-                        * gae
+                    # Nomalise advantage at minibatch level, with the mean and variance taken from a
+                    # single fused pass over the sum and sum of squares.
+                    gae_mean = gae.mean()
+                    gae_var = jnp.maximum(jnp.mean(gae * gae) - gae_mean * gae_mean, 0.0)
+                    gae = (gae - gae_mean) / (jnp.sqrt(gae_var) + 1e-8)
+                    # Clipped surrogate: min(ratio * gae, clip(ratio) * gae) only clips the ratio
+                    # from above when gae >= 0 and from below when gae < 0.
+                    clipped_ratio = jnp.where(
+                        gae >= 0,
+                        jnp.minimum(ratio, 1.0 + config.system.clip_eps),
+                        jnp.maximum(ratio, 1.0 - config.system.clip_eps),
                     )
-                    actor_loss = -jnp.minimum(actor_loss1, actor_loss2)
+                    actor_loss = -(clipped_ratio * gae)
                     actor_loss = actor_loss.mean()
                     # The seed will be used in the TanhTransformedDistribution:
                     entropy = actor_policy.entropy(seed=key).mean()
@@ -209,22 +215,13 @@ def get_learner_fn(
                     params.critic_params, traj_batch, targets
                 )
 
-                # Compute the parallel mean (pmean) over the batch.
-                # This pmean could be a regular mean as the batch axis is on the same device.
+                # Compute the parallel mean (pmean) over the batch and devices in one collective.
                 actor_grads, actor_loss_info = jax.lax.pmean(
-                    (actor_grads, actor_loss_info), axis_name="batch"
-                )
-                # pmean over devices.
-                actor_grads, actor_loss_info = jax.lax.pmean(
-                    (actor_grads, actor_loss_info), axis_name="device"
+                    (actor_grads, actor_loss_info), axis_name=("batch", "device")
                 )
 
                 critic_grads, value_loss_info = jax.lax.pmean(
-                    (critic_grads, value_loss_info), axis_name="batch"
-                )
-                # pmean over devices.
-                critic_grads, value_loss_info = jax.lax.pmean(
-                    (critic_grads, value_loss_info), axis_name="device"
+                    (critic_grads, value_loss_info), axis_name=("batch", "device")
                 )
 
                 # Update params and optimiser state
@@ -372,15 +369,14 @@ def learner_setup(
 
     # Get batched iterated update and replicate it to pmap it over cores.
     learn = get_learner_fn(env, apply_fns, update_fns, config)
-    learn = jax.pmap(learn, axis_name="device")
+    learn = jax.pmap(learn, axis_name="device", donate_argnums=0)
 
     # Initialise environment states and timesteps: across devices and batches.
-    key, *env_keys = jax.random.split(
+    keys = jax.random.split(
         key, n_devices * config.system.update_batch_size * config.arch.num_envs + 1
     )
-    env_states, timesteps = jax.vmap(env.reset, in_axes=(0))(
-        jnp.stack(env_keys),
-    )
+    key, env_keys = keys[0], keys[1:]
+    env_states, timesteps = jax.vmap(env.reset, in_axes=(0))(env_keys)
     reshape_states = lambda x: x.reshape(
         (n_devices, config.system.update_batch_size, config.arch.num_envs) + x.shape[1:]
     )
@@ -479,18 +475,43 @@ def run_experiment(_config: DictConfig) -> float:
             **config.logger.checkpointing.save_args,  # Checkpoint args
         )
 
+    # Compile the learner ahead of time, so the first training phase only measures execution.
+    learn = learn.lower(learner_state).compile()  # type: ignore
+
     # Run experiment for a total number of evaluations.
     max_episode_return = -jnp.inf
     best_params = None
+    # Each training phase is dispatched as soon as the previous one is evaluated, so that the
+    # device keeps training while the host logs and checkpoints. Evaluation blocks on its own
+    # results and stays ahead of the dispatch so that it does not queue behind the next phase.
+    start_time = time.time()
+    learner_output = learn(learner_state)
     for eval_step in range(config.arch.num_evaluation):
         # Train.
-        start_time = time.time()
-
-        learner_output = learn(learner_state)
         jax.block_until_ready(learner_output)
+        elapsed_time = time.time() - start_time
+
+        # Prepare for evaluation.
+        trained_params = unreplicate_batch_dim(learner_output.learner_state.params.actor_params)
+        key_e, *eval_keys = jax.random.split(key_e, n_devices + 1)
+        eval_keys = jnp.stack(eval_keys)
+        eval_keys = eval_keys.reshape(n_devices, -1)
+        # Evaluate.
+        eval_metrics = evaluator(trained_params, eval_keys, {})
+
+        # The next training phase donates the current learner state, so slice out what is
+        # checkpointed before dispatching it.
+        if save_checkpoint:
+            unreplicated_learner_state = unreplicate_n_dims(learner_output.learner_state)
+
+        # Dispatch the next training phase, it runs on device right after the evaluation.
+        if eval_step + 1 < config.arch.num_evaluation:
+            next_learner_output = learn(learner_output.learner_state)
+            # Time the next phase from its dispatch, so its steps per second cover all the time
+            # the device spends on it.
+            start_time = time.time()
 
         # Log the results of the training.
-        elapsed_time = time.time() - start_time
         t = int(steps_per_rollout * (eval_step + 1))
         episode_metrics, ep_completed = get_final_step_metrics(learner_output.episode_metrics)
         episode_metrics["steps_per_second"] = steps_per_rollout / elapsed_time
@@ -501,13 +522,7 @@ def run_experiment(_config: DictConfig) -> float:
             logger.log(episode_metrics, t, eval_step, LogEvent.ACT)
         logger.log(learner_output.train_metrics, t, eval_step, LogEvent.TRAIN)
 
-        # Prepare for evaluation.
-        trained_params = unreplicate_batch_dim(learner_state.params.actor_params)
-        key_e, *eval_keys = jax.random.split(key_e, n_devices + 1)
-        eval_keys = jnp.stack(eval_keys)
-        eval_keys = eval_keys.reshape(n_devices, -1)
-        # Evaluate.
-        eval_metrics = evaluator(trained_params, eval_keys, {})
+        # Log the results of the evaluation.
         logger.log(eval_metrics, t, eval_step, LogEvent.EVAL)
         episode_return = jnp.mean(eval_metrics["episode_return"])
 
@@ -515,7 +530,7 @@ def run_experiment(_config: DictConfig) -> float:
             # Save checkpoint of learner state
             checkpointer.save(
                 timestep=steps_per_rollout * (eval_step + 1),
-                unreplicated_learner_state=unreplicate_n_dims(learner_output.learner_state),
+                unreplicated_learner_state=unreplicated_learner_state,
                 episode_return=episode_return,
             )
 
@@ -524,7 +539,8 @@ def run_experiment(_config: DictConfig) -> float:
             max_episode_return = episode_return
 
         # Update runner state to continue training.
-        learner_state = learner_output.learner_state
+        if eval_step + 1 < config.arch.num_evaluation:
+            learner_output = next_learner_output
 
     # Record the performance for the final evaluation run.
     eval_performance = float(jnp.mean(eval_metrics[config.env.eval_metric]))
@@ -108,17 +108,20 @@ def get_learner_fn(
             # Reset hidden state if done.
             done = timestep.last()
             done = jnp.expand_dims(done, (1, 2, 3, 4))
-            hstates = tree.map(lambda hs: jnp.where(done, jnp.zeros_like(hs), hs), hstates)
+            hstates = tree.map(lambda hs: jnp.where(done, 0.0, hs), hstates)
 
-            prev_done = last_timestep.last().repeat(env.num_agents).reshape(num_envs, -1)
+            prev_done = jnp.broadcast_to(
+                last_timestep.last()[:, jnp.newaxis], (num_envs, env.num_agents)
+            )
             transition = Transition(
                 prev_done, action, value, timestep.reward, log_prob, last_timestep.observation
             )
             learner_state = LearnerState(params, opt_states, key, env_state, timestep, hstates)
             return learner_state, (transition, timestep.extras["episode_metrics"])
 
-        # Copy old hidden states: to be used in the training loop
-        prev_hstates = tree.map(lambda x: jnp.copy(x), learner_state.hstates)
+        # Keep the hidden states from before the rollout: to be used in the training loop.
+        # Jax arrays are immutable so no copy is needed.
+        prev_hstates = learner_state.hstates
 
         # Step environment for rollout length
         learner_state, (traj_batch, episode_metrics) = jax.lax.scan(
@@ -131,7 +134,9 @@ def get_learner_fn(
         _, _, last_val, _ = sable_action_select_fn(  # type: ignore
             params, last_timestep.observation, updated_hstates, last_val_key
         )
-        last_done = last_timestep.last().repeat(env.num_agents).reshape(num_envs, -1)
+        last_done = jnp.broadcast_to(
+            last_timestep.last()[:, jnp.newaxis], (num_envs, env.num_agents)
+        )
 
         def _calculate_gae(
             traj_batch: Transition,
@@ -139,28 +144,30 @@ def get_learner_fn(
             current_done: chex.Array,
         ) -> Tuple[chex.Array, chex.Array]:
             """Calculate the GAE."""
+            gamma, gae_lambda = config.system.gamma, config.system.gae_lambda
+
+            # The TD errors do not depend on the scan carry, so they are computed for the whole
+            # rollout in one vectorised pass and only the discounted sum is scanned.
+            next_value = jnp.concatenate([traj_batch.value[1:], current_val[jnp.newaxis]])
+            next_done = jnp.concatenate([traj_batch.done[1:], current_done[jnp.newaxis]])
+            not_done = 1.0 - next_done.astype(traj_batch.value.dtype)
+            delta = traj_batch.reward + gamma * next_value * not_done - traj_batch.value
+            gae_discount = gamma * gae_lambda * not_done
 
             def _get_advantages(
-                carry: Tuple[chex.Array, chex.Array, chex.Array], transition: Transition
-            ) -> Tuple[Tuple[chex.Array, chex.Array, chex.Array], chex.Array]:
+                gae: chex.Array, delta_and_discount: Tuple[chex.Array, chex.Array]
+            ) -> Tuple[chex.Array, chex.Array]:
                 """Calculate the GAE for a single transition."""
-                gae, next_value, next_done = carry
-                done, value, reward = (
-                    transition.done,
-                    transition.value,
-                    transition.reward,
-                )
-                gamma = config.system.gamma
-                delta = reward + gamma * next_value * (1 - next_done) - value
-                gae = delta + gamma * config.system.gae_lambda * (1 - next_done) * gae
-                return (gae, value, done), gae
+                delta, gae_discount = delta_and_discount
+                gae = delta + gae_discount * gae
+                return gae, gae
 
             _, advantages = jax.lax.scan(
                 _get_advantages,
-                (jnp.zeros_like(current_val), current_val, current_done),
-                traj_batch,
+                jnp.zeros_like(current_val),
+                (delta, gae_discount),
                 reverse=True,
-                unroll=16,
+                unroll=config.system.gae_unroll,
             )
             return advantages, advantages + traj_batch.value
 
@@ -195,18 +202,19 @@ def get_learner_fn(
 
                     # Calculate actor loss
                     ratio = jnp.exp(log_prob - traj_batch.log_prob)
-                    # Nomalise advantage at minibatch level
-                    gae = (gae - gae.mean()) / (gae.std() + 1e-8)
-                    actor_loss1 = ratio * gae
-                    actor_loss2 = (
-                        jnp.clip(
-                            ratio,
-                            1.0 - config.system.clip_eps,
-                            1.0 + config.system.clip_eps,
-                        )
-                        * gae
+                    # Nomalise advantage at minibatch level, with the mean and variance taken from a
+                    # single fused pass over the sum and sum of squares.
+                    gae_mean = gae.mean()
+                    gae_var = jnp.maximum(jnp.mean(gae * gae) - gae_mean * gae_mean, 0.0)
+                    gae = (gae - gae_mean) / (jnp.sqrt(gae_var) + 1e-8)
+                    # Clipped surrogate: min(ratio * gae, clip(ratio) * gae) only clips the ratio
+                    # from above when gae >= 0 and from below when gae < 0.
+                    clipped_ratio = jnp.where(
+                        gae >= 0,
+                        jnp.minimum(ratio, 1.0 + config.system.clip_eps),
+                        jnp.maximum(ratio, 1.0 - config.system.clip_eps),
                     )
-                    actor_loss = -jnp.minimum(actor_loss1, actor_loss2)
+                    actor_loss = -(clipped_ratio * gae)
                     actor_loss = actor_loss.mean()
                     entropy = entropy.mean()
 
@@ -237,11 +245,8 @@ def get_learner_fn(
                     entropy_key,
                 )
 
-                # Compute the parallel mean (pmean) over the batch.
-                # This pmean could be a regular mean as the batch axis is on the same device.
-                grads, loss_info = jax.lax.pmean((grads, loss_info), axis_name="batch")
-                # pmean over devices.
-                grads, loss_info = jax.lax.pmean((grads, loss_info), axis_name="device")
+                # Compute the parallel mean (pmean) over the batch and devices in one collective.
+                grads, loss_info = jax.lax.pmean((grads, loss_info), axis_name=("batch", "device"))
 
                 # Update params and optimiser state
                 updates, new_opt_state = update_fn(grads, opt_state)
@@ -262,29 +267,29 @@ def get_learner_fn(
             # Shuffle minibatches
             key, batch_shuffle_key, agent_shuffle_key, entropy_key = jax.random.split(key, 4)
 
-            # Shuffle batch
+            # Shuffle batch and agents
             batch_size = config.arch.num_envs
             batch_perm = jax.random.permutation(batch_shuffle_key, batch_size)
-            batch = (traj_batch, advantages, targets)
-            batch = tree.map(lambda x: jnp.take(x, batch_perm, axis=1), batch)
-
-            # Shuffle hidden states
-            prev_hstates = tree.map(lambda x: jnp.take(x, batch_perm, axis=0), prev_hstates)
-
-            # Shuffle agents
             agent_perm = jax.random.permutation(agent_shuffle_key, config.system.num_agents)
-            batch = tree.map(lambda x: jnp.take(x, agent_perm, axis=2), batch)
 
-            # Concatenate time and agents
-            batch = tree.map(concat_time_and_agents, batch)
+            def _shuffle_and_split(x: chex.Array) -> chex.Array:
+                """Shuffles the batch and agents of a leaf, concatenates its time and agent
+                dimensions and splits it into minibatches."""
+                x = concat_time_and_agents(jnp.take(x, agent_perm, axis=2))
+                # Shuffle the batch once it is the leading axis, so that every environment's
+                # trajectory is gathered as one contiguous row.
+                x = jnp.take(x, batch_perm, axis=0)
+                return x.reshape(config.system.num_minibatches, -1, *x.shape[1:])
 
-            # Split into minibatches
-            minibatches = tree.map(
-                lambda x: jnp.reshape(x, (config.system.num_minibatches, -1, *x.shape[1:])),
-                batch,
-            )
+            minibatches = tree.map(_shuffle_and_split, (traj_batch, advantages, targets))
+
+            # Shuffle hidden states and split them into minibatches. The shuffled copy stays local
+            # to the epoch, like the shuffled trajectories, so every epoch permutes the hidden
+            # states that line up with `traj_batch`.
             prev_hs_minibatch = tree.map(
-                lambda x: jnp.reshape(x, (config.system.num_minibatches, -1, *x.shape[1:])),
+                lambda x: jnp.take(x, batch_perm, axis=0).reshape(
+                    config.system.num_minibatches, -1, *x.shape[1:]
+                ),
                 prev_hstates,
             )
 
@@ -368,12 +373,21 @@ def learner_setup(
 
     # Setting the chunksize - smaller chunks save memory at the cost of speed
     if config.network.memory_config.timestep_chunk_size:
+        err = "Rollout length should be divisible by timestep chunk size"
+        rollout_length = config.system.rollout_length
+        assert rollout_length % config.network.memory_config.timestep_chunk_size == 0, err
         config.network.memory_config.chunk_size = (
             config.network.memory_config.timestep_chunk_size * n_agents
         )
     else:
         config.network.memory_config.chunk_size = config.system.rollout_length * n_agents
 
+    # The timestep positional encoding is precomputed for every step count up to the time limit.
+    if config.network.memory_config.max_timestep is None:
+        config.network.memory_config.max_timestep = env.time_limit
+    err = "memory_config.max_timestep should be at least the environment time limit"
+    assert config.network.memory_config.max_timestep >= env.time_limit, err
+
     _, action_space_type = get_action_head(env.action_spec)
 
     # Define network.
@@ -417,15 +431,14 @@ def learner_setup(
 
     # Get batched iterated update and replicate it to pmap it over cores.
     learn = get_learner_fn(env, apply_fns, optim.update, config)
-    learn = jax.pmap(learn, axis_name="device")
+    learn = jax.pmap(learn, axis_name="device", donate_argnums=0)
 
     # Initialise environment states and timesteps: across devices and batches.
-    key, *env_keys = jax.random.split(
+    keys = jax.random.split(
         key, n_devices * config.system.update_batch_size * config.arch.num_envs + 1
     )
-    env_states, timesteps = jax.vmap(env.reset, in_axes=(0))(
-        jnp.stack(env_keys),
-    )
+    key, env_keys = keys[0], keys[1:]
+    env_states, timesteps = jax.vmap(env.reset, in_axes=(0))(env_keys)
     reshape_states = lambda x: x.reshape(
         (n_devices, config.system.update_batch_size, config.arch.num_envs) + x.shape[1:]
     )
@@ -553,18 +566,43 @@ def run_experiment(_config: DictConfig) -> float:
     eval_hs = get_init_hidden_state(config.network.net_config, eval_batch_size)
     eval_hs = flax.jax_utils.replicate(eval_hs, devices=jax.devices())
 
+    # Compile the learner ahead of time, so the first training phase only measures execution.
+    learn = learn.lower(learner_state).compile()  # type: ignore
+
     # Run experiment for a total number of evaluations.
     max_episode_return = -jnp.inf
     best_params = None
+    # Each training phase is dispatched as soon as the previous one is evaluated, so that the
+    # device keeps training while the host logs and checkpoints. Evaluation blocks on its own
+    # results and stays ahead of the dispatch so that it does not queue behind the next phase.
+    start_time = time.time()
+    learner_output = learn(learner_state)
     for eval_step in range(config.arch.num_evaluation):
         # Train.
-        start_time = time.time()
-
-        learner_output = learn(learner_state)
         jax.block_until_ready(learner_output)
+        elapsed_time = time.time() - start_time
+
+        # Prepare for evaluation.
+        trained_params = unreplicate_batch_dim(learner_output.learner_state.params)
+        key_e, *eval_keys = jax.random.split(key_e, n_devices + 1)
+        eval_keys = jnp.stack(eval_keys)
+        eval_keys = eval_keys.reshape(n_devices, -1)
+        # Evaluate.
+        eval_metrics = evaluator(trained_params, eval_keys, {"hidden_state": eval_hs})
+
+        # The next training phase donates the current learner state, so slice out what is
+        # checkpointed before dispatching it.
+        if save_checkpoint:
+            unreplicated_learner_state = unreplicate_n_dims(learner_output.learner_state)
+
+        # Dispatch the next training phase, it runs on device right after the evaluation.
+        if eval_step + 1 < config.arch.num_evaluation:
+            next_learner_output = learn(learner_output.learner_state)
+            # Time the next phase from its dispatch, so its steps per second cover all the time
+            # the device spends on it.
+            start_time = time.time()
 
         # Log the results of the training.
-        elapsed_time = time.time() - start_time
         t = int(steps_per_rollout * (eval_step + 1))
         episode_metrics, ep_completed = get_final_step_metrics(learner_output.episode_metrics)
         episode_metrics["steps_per_second"] = steps_per_rollout / elapsed_time
@@ -575,13 +613,7 @@ def run_experiment(_config: DictConfig) -> float:
             logger.log(episode_metrics, t, eval_step, LogEvent.ACT)
         logger.log(learner_output.train_metrics, t, eval_step, LogEvent.TRAIN)
 
-        # Prepare for evaluation.
-        trained_params = unreplicate_batch_dim(learner_state.params)
-        key_e, *eval_keys = jax.random.split(key_e, n_devices + 1)
-        eval_keys = jnp.stack(eval_keys)
-        eval_keys = eval_keys.reshape(n_devices, -1)
-        # Evaluate.
-        eval_metrics = evaluator(trained_params, eval_keys, {"hidden_state": eval_hs})
+        # Log the results of the evaluation.
         logger.log(eval_metrics, t, eval_step, LogEvent.EVAL)
         episode_return = jnp.mean(eval_metrics["episode_return"])
 
@@ -589,7 +621,7 @@ def run_experiment(_config: DictConfig) -> float:
             # Save checkpoint of learner state
             checkpointer.save(
                 timestep=steps_per_rollout * (eval_step + 1),
-                unreplicated_learner_state=unreplicate_n_dims(learner_output.learner_state),
+                unreplicated_learner_state=unreplicated_learner_state,
                 episode_return=episode_return,
             )
 
@@ -598,7 +630,8 @@ def run_experiment(_config: DictConfig) -> float:
             max_episode_return = episode_return
 
         # Update runner state to continue training.
-        learner_state = learner_output.learner_state
+        if eval_step + 1 < config.arch.num_evaluation:
+            learner_output = next_learner_output
 
     # Record the performance for the final evaluation run.
     eval_performance = float(jnp.mean(eval_metrics[config.env.eval_metric]))